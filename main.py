@@ -1,46 +1,106 @@
 import os
-import json
+import copy
+import time
 import uuid
+import queue
+import logging
+import secrets
+from logging.handlers import QueueHandler, QueueListener
 import asyncio
+import aiofiles
 import httpx
+import msgspec
+import orjson
 from typing import Optional, Dict, Any
 from pathlib import Path
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request, Response
+from fastapi.responses import FileResponse, ORJSONResponse
+from pydantic import BaseModel
 import websockets
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
 COMFY_URL = os.getenv("COMFY_URL", "http://192.168.1.7:8188")
 COMFY_OUTPUT_DIR = os.getenv("COMFY_OUTPUT_DIR", "./output")
 WORKFLOW_PATH = os.getenv("WORKFLOW_PATH", "./workflow_api.json")
+PENDING_RESULT_TTL = 60.0
 
 os.makedirs(COMFY_OUTPUT_DIR, exist_ok=True)
 
+_log_queue: queue.Queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+
+logger = logging.getLogger("comfyui_bridge")
+logger.setLevel(logging.INFO)
+logger.addHandler(QueueHandler(_log_queue))
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print(f"Starting FastAPI ComfyUI Bridge")
-    print(f"ComfyUI URL: {COMFY_URL}")
-    print(f"Output Directory: {COMFY_OUTPUT_DIR}")
+    _log_listener.start()
+    logger.info("Starting FastAPI ComfyUI Bridge")
+    logger.info("ComfyUI URL: %s", COMFY_URL)
+    logger.info("Output Directory: %s", COMFY_OUTPUT_DIR)
+
+    loop = asyncio.get_running_loop()
+    if hasattr(asyncio, "eager_task_factory"):
+        loop.set_task_factory(asyncio.eager_task_factory)
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=8, thread_name_prefix="bridge-io"))
+
+    client.load_workflow_template(WORKFLOW_PATH)
+    logger.info("Loaded workflow template from %s", WORKFLOW_PATH)
+
+    app.state.http = httpx.AsyncClient(
+        base_url=COMFY_URL,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=40,
+            keepalive_expiry=30.0
+        )
+    )
+    client.http = app.state.http
+    app.state.ws_task = asyncio.create_task(client.run_ws_reader())
+
     yield
-    print("Shutting down FastAPI ComfyUI Bridge")
+
+    app.state.ws_task.cancel()
+    try:
+        await app.state.ws_task
+    except asyncio.CancelledError:
+        pass
+    await app.state.http.aclose()
+    logger.info("Shutting down FastAPI ComfyUI Bridge")
+    _log_listener.stop()
 
 
 app = FastAPI(
     title="ComfyUI Bridge API",
     description="FastAPI bridge to control a remote ComfyUI server",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 
-class GenerateImageRequest(BaseModel):
-    prompt: str = Field(..., description="Positive prompt text for image generation")
-    negative_prompt: Optional[str] = Field("", description="Negative prompt text (optional)")
+class GenerateImageRequest(msgspec.Struct):
+    prompt: str
+    negative_prompt: str = ""
+
+
+_generate_request_decoder = msgspec.json.Decoder(GenerateImageRequest)
+
+
+async def parse_generate_request(request: Request) -> GenerateImageRequest:
+    try:
+        return _generate_request_decoder.decode(await request.body())
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except msgspec.DecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
 
 
 class GenerateImageResponse(BaseModel):
@@ -51,25 +111,84 @@ class GenerateImageResponse(BaseModel):
 
 
 class ComfyUIClient:
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, http: Optional[httpx.AsyncClient] = None):
         self.base_url = base_url.rstrip("/")
         self.ws_url = self.base_url.replace("http://", "ws://").replace("https://", "wss://")
-
-    def load_workflow(self, workflow_path: str) -> Dict[str, Any]:
+        self.http = http
+        self.client_id = uuid.uuid4().hex
+        self.pending: Dict[str, asyncio.Future] = {}
+        self._image_outputs: Dict[str, Dict[str, Any]] = {}
+        self.generated_paths: Dict[str, str] = {}
+        self.workflow_template: Optional[Dict[str, Any]] = None
+        self.workflow_index: Dict[str, list] = {"positive": [], "negative": [], "ksamplers": []}
+
+    def load_workflow_template(self, workflow_path: str) -> None:
         try:
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                workflow = json.load(f)
-            return workflow
+            with open(workflow_path, "rb") as f:
+                self.workflow_template = orjson.loads(f.read())
         except FileNotFoundError:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Workflow file not found: {workflow_path}. Please place your workflow_api.json in the project root."
+            raise RuntimeError(
+                f"Workflow file not found: {workflow_path}. Please place your workflow_api.json in the project root."
             )
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
+            raise RuntimeError("Invalid workflow JSON file")
+
+        if not isinstance(self.workflow_template, dict):
+            raise RuntimeError("Workflow JSON must be an object mapping node IDs to nodes")
+
+        for node_id, node_data in self.workflow_template.items():
+            if not isinstance(node_data, dict):
+                continue
+
+            if "class_type" not in node_data:
+                raise RuntimeError(
+                    f"Workflow node {node_id} has no class_type. Did you export in API format?"
+                )
+
+            if not isinstance(node_data.get("inputs", {}), dict):
+                raise RuntimeError(f"Workflow node {node_id} has malformed inputs")
+
+        self.workflow_index = self._index_workflow(self.workflow_template)
+
+    def _index_workflow(self, workflow: Dict[str, Any]) -> Dict[str, list]:
+        index: Dict[str, list] = {"positive": [], "negative": [], "ksamplers": []}
+
+        for node_id, node_data in workflow.items():
+            if not isinstance(node_data, dict):
+                continue
+
+            class_type = node_data.get("class_type", "")
+
+            if class_type == "CLIPTextEncode":
+                current_text = node_data.get("inputs", {}).get("text", "")
+
+                if not isinstance(current_text, str):
+                    logger.info("Skipping link-fed text node %s", node_id)
+                    continue
+
+                if "negative" in current_text.lower() or "bad" in current_text.lower():
+                    index["negative"].append(node_id)
+                    logger.info("Indexed negative prompt node %s", node_id)
+                else:
+                    index["positive"].append(node_id)
+                    logger.info("Indexed positive prompt node %s", node_id)
+
+            elif class_type == "KSampler":
+                index["ksamplers"].append(node_id)
+                logger.info("Indexed KSampler node %s", node_id)
+
+        if not any(index.values()):
+            logger.warning("No CLIPTextEncode or KSampler nodes found in workflow")
+
+        return index
+
+    def load_workflow(self) -> Dict[str, Any]:
+        if self.workflow_template is None:
             raise HTTPException(
                 status_code=500,
-                detail="Invalid workflow JSON file"
+                detail="Workflow template not loaded"
             )
+        return copy.deepcopy(self.workflow_template)
 
     def modify_workflow(
         self,
@@ -77,128 +196,219 @@ class ComfyUIClient:
         positive_prompt: str,
         negative_prompt: str = ""
     ) -> Dict[str, Any]:
-        modified = False
+        for node_id in self.workflow_index["positive"]:
+            workflow[node_id]["inputs"]["text"] = positive_prompt
 
-        for node_id, node_data in workflow.items():
-            if isinstance(node_data, dict):
-                class_type = node_data.get("class_type", "")
-
-                if class_type == "CLIPTextEncode":
-                    inputs = node_data.get("inputs", {})
-                    current_text = inputs.get("text", "")
-
-                    if "negative" in current_text.lower() or "bad" in current_text.lower():
-                        inputs["text"] = negative_prompt
-                        print(f"Set negative prompt in node {node_id}")
-                    else:
-                        inputs["text"] = positive_prompt
-                        print(f"Set positive prompt in node {node_id}")
-                    modified = True
-
-                elif class_type == "KSampler":
-                    inputs = node_data.get("inputs", {})
-                    inputs["seed"] = uuid.uuid4().int % (2**32)
-                    print(f"Randomized seed in node {node_id}: {inputs['seed']}")
-                    modified = True
-
-        if not modified:
-            print("Warning: No CLIPTextEncode or KSampler nodes found in workflow")
+        for node_id in self.workflow_index["negative"]:
+            workflow[node_id]["inputs"]["text"] = negative_prompt
+
+        for node_id in self.workflow_index["ksamplers"]:
+            workflow[node_id]["inputs"]["seed"] = secrets.randbits(32)
 
         return workflow
 
     async def queue_prompt(self, workflow: Dict[str, Any]) -> str:
-        payload = {"prompt": workflow}
+        body = orjson.dumps(
+            {"prompt": workflow, "client_id": self.client_id},
+            option=orjson.OPT_SORT_KEYS
+        )
+
+        try:
+            response = await self.http.post(
+                "/prompt",
+                content=body,
+                headers={"Content-Type": "application/json"}
+            )
+            response.raise_for_status()
+            result = orjson.loads(response.content)
+            prompt_id = result.get("prompt_id")
+
+            if not prompt_id:
+                raise HTTPException(status_code=500, detail="No prompt_id returned from ComfyUI")
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
+            logger.info("Queued prompt with ID: %s", prompt_id)
+            return prompt_id
+
+        except httpx.HTTPError as e:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Failed to connect to ComfyUI at {self.base_url}: {str(e)}"
+            )
+
+    def connect_ws(self):
+        return websockets.connect(
+            f"{self.ws_url}/ws?clientId={self.client_id}",
+            compression="deflate",
+            max_size=2**22,
+            write_limit=2**16,
+            open_timeout=5,
+            ping_interval=20,
+            ping_timeout=20
+        )
+
+    async def run_ws_reader(self) -> None:
+        backoff = 0.5
+
+        while True:
             try:
-                response = await client.post(f"{self.base_url}/prompt", json=payload)
-                response.raise_for_status()
-                result = response.json()
-                prompt_id = result.get("prompt_id")
+                async with self.connect_ws() as websocket:
+                    logger.info("Connected to ComfyUI websocket")
+                    backoff = 0.5
+
+                    if self.pending:
+                        await self._reconcile_pending()
+
+                    async for message in websocket:
+                        try:
+                            self._handle_ws_message(message)
+                        except Exception:
+                            logger.exception("Error handling websocket message")
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("WebSocket reader disconnected: %s; reconnecting in %.1fs", e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 10.0)
+
+    async def _reconcile_pending(self) -> None:
+        for prompt_id in list(self.pending):
+            future = self.pending.get(prompt_id)
+            if future is None or future.done():
+                continue
 
-                if not prompt_id:
-                    raise HTTPException(status_code=500, detail="No prompt_id returned from ComfyUI")
+            try:
+                history = await self.get_history(prompt_id)
+            except HTTPException as e:
+                logger.warning("Could not reconcile prompt %s: %s", prompt_id, e.detail)
+                continue
+
+            entry = history.get(prompt_id)
+            if not entry:
+                continue
+
+            status = entry.get("status", {})
+            if status.get("status_str") == "error":
+                logger.warning("Reconciled prompt %s from history: execution error", prompt_id)
+                future.set_exception(HTTPException(
+                    status_code=500,
+                    detail=f"ComfyUI execution error: {status}"
+                ))
+                continue
+
+            image_info = None
+            for node_output in entry.get("outputs", {}).values():
+                if "images" in node_output and len(node_output["images"]) > 0:
+                    image_info = node_output["images"][0]
+                    break
+
+            logger.info("Reconciled prompt %s from history", prompt_id)
+            future.set_result(image_info)
+
+    def _handle_ws_message(self, message) -> None:
+        if isinstance(message, bytes):
+            return
+
+        if (
+            '"executing"' not in message
+            and '"executed"' not in message
+            and '"execution_error"' not in message
+        ):
+            return
+
+        data = orjson.loads(message)
+
+        msg_type = data.get("type")
+        msg_data = data.get("data", {})
+        prompt_id = msg_data.get("prompt_id")
+
+        if not prompt_id:
+            return
+
+        if msg_type == "executed":
+            output = msg_data.get("output") or {}
+            images = output.get("images") or []
+            if images:
+                self._image_outputs[prompt_id] = images[0]
+
+        elif msg_type == "executing" and msg_data.get("node") is None:
+            logger.info("Execution completed for prompt %s", prompt_id)
+            future = self._completion_future(prompt_id)
+            if not future.done():
+                future.set_result(self._image_outputs.pop(prompt_id, None))
+            self._schedule_pending_expiry(prompt_id, future)
+
+        elif msg_type == "execution_error":
+            future = self._completion_future(prompt_id)
+            if not future.done():
+                future.set_exception(HTTPException(
+                    status_code=500,
+                    detail=f"ComfyUI execution error: {msg_data}"
+                ))
+            self._schedule_pending_expiry(prompt_id, future)
+
+    def _completion_future(self, prompt_id: str) -> asyncio.Future:
+        future = self.pending.get(prompt_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[prompt_id] = future
+        return future
+
+    def _schedule_pending_expiry(self, prompt_id: str, future: asyncio.Future) -> None:
+        asyncio.get_running_loop().call_later(
+            PENDING_RESULT_TTL, self._expire_pending, prompt_id, future
+        )
 
-                print(f"Queued prompt with ID: {prompt_id}")
-                return prompt_id
+    def _expire_pending(self, prompt_id: str, future: asyncio.Future) -> None:
+        if self.pending.get(prompt_id) is not future:
+            return
 
-            except httpx.HTTPError as e:
-                raise HTTPException(
-                    status_code=503,
-                    detail=f"Failed to connect to ComfyUI at {self.base_url}: {str(e)}"
-                )
+        del self.pending[prompt_id]
+        self._image_outputs.pop(prompt_id, None)
+        if future.done() and not future.cancelled():
+            future.exception()
+        logger.warning("Expired unclaimed result for prompt %s", prompt_id)
 
-    async def wait_for_completion(self, prompt_id: str, timeout: int = 300) -> bool:
-        ws_url = f"{self.ws_url}/ws?clientId={uuid.uuid4()}"
+    async def wait_for_completion(self, prompt_id: str, timeout: int = 300) -> Optional[Dict[str, Any]]:
+        future = self._completion_future(prompt_id)
 
         try:
-            async with websockets.connect(ws_url) as websocket:
-                print(f"Connected to ComfyUI websocket")
-                start_time = asyncio.get_event_loop().time()
-
-                while True:
-                    if asyncio.get_event_loop().time() - start_time > timeout:
-                        raise HTTPException(status_code=504, detail="Timeout waiting for image generation")
-
-                    try:
-                        message = await asyncio.wait_for(websocket.recv(), timeout=5.0)
-                        data = json.loads(message)
-
-                        msg_type = data.get("type")
-
-                        if msg_type == "executing":
-                            exec_data = data.get("data", {})
-                            exec_prompt_id = exec_data.get("prompt_id")
-                            node = exec_data.get("node")
-
-                            if exec_prompt_id == prompt_id and node is None:
-                                print(f"Execution completed for prompt {prompt_id}")
-                                return True
-
-                        elif msg_type == "execution_error":
-                            error_data = data.get("data", {})
-                            if error_data.get("prompt_id") == prompt_id:
-                                raise HTTPException(
-                                    status_code=500,
-                                    detail=f"ComfyUI execution error: {error_data}"
-                                )
-
-                    except asyncio.TimeoutError:
-                        continue
-
-        except Exception as e:
-            if isinstance(e, HTTPException):
-                raise e
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Timeout waiting for image generation")
+        finally:
+            self.pending.pop(prompt_id, None)
+            self._image_outputs.pop(prompt_id, None)
+
+    async def get_history(self, prompt_id: str) -> Dict[str, Any]:
+        try:
+            response = await self.http.get(f"/history/{prompt_id}")
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except httpx.HTTPError as e:
             raise HTTPException(
                 status_code=500,
-                detail=f"WebSocket error: {str(e)}"
+                detail=f"Failed to get history: {str(e)}"
             )
 
-    async def get_history(self, prompt_id: str) -> Dict[str, Any]:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            try:
-                response = await client.get(f"{self.base_url}/history/{prompt_id}")
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPError as e:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to get history: {str(e)}"
-                )
-
-    async def download_image(self, prompt_id: str, output_dir: str) -> str:
-        history = await self.get_history(prompt_id)
+    async def download_image(
+        self,
+        prompt_id: str,
+        output_dir: str,
+        image_info: Optional[Dict[str, Any]] = None
+    ) -> str:
+        if image_info is None:
+            history = await self.get_history(prompt_id)
 
-        if prompt_id not in history:
-            raise HTTPException(status_code=404, detail="Prompt ID not found in history")
+            if prompt_id not in history:
+                raise HTTPException(status_code=404, detail="Prompt ID not found in history")
 
-        outputs = history[prompt_id].get("outputs", {})
+            outputs = history[prompt_id].get("outputs", {})
 
-        image_info = None
-        for node_id, node_output in outputs.items():
-            if "images" in node_output and len(node_output["images"]) > 0:
-                image_info = node_output["images"][0]
-                break
+            for node_id, node_output in outputs.items():
+                if "images" in node_output and len(node_output["images"]) > 0:
+                    image_info = node_output["images"][0]
+                    break
 
         if not image_info:
             raise HTTPException(status_code=404, detail="No output images found")
@@ -216,53 +426,72 @@ class ComfyUIClient:
             "type": folder_type
         }
 
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            try:
-                response = await client.get(f"{self.base_url}/view", params=params)
+        output_path = Path(output_dir) / f"{prompt_id}_{filename}"
+        temp_path = output_path.with_name(output_path.name + ".part")
+
+        try:
+            async with self.http.stream("GET", "/view", params=params) as response:
                 response.raise_for_status()
 
-                output_path = Path(output_dir) / f"{prompt_id}_{filename}"
+                async with aiofiles.open(temp_path, "wb") as f:
+                    async for chunk in response.aiter_bytes(65536):
+                        await f.write(chunk)
 
-                with open(output_path, "wb") as f:
-                    f.write(response.content)
+            os.replace(temp_path, output_path)
 
-                print(f"Image saved to: {output_path}")
-                return str(output_path)
+            logger.info("Image saved to: %s", output_path)
+            self.generated_paths[prompt_id] = str(output_path)
+            return str(output_path)
 
-            except httpx.HTTPError as e:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to download image: {str(e)}"
-                )
+        except httpx.HTTPError as e:
+            temp_path.unlink(missing_ok=True)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to download image: {str(e)}"
+            )
 
 
 client = ComfyUIClient(COMFY_URL)
 
 
+_ROOT_BODY = orjson.dumps({
+    "message": "ComfyUI Bridge API is running",
+    "comfy_url": COMFY_URL,
+    "endpoints": {
+        "generate_image": "/generate-image (POST)",
+        "health": "/health (GET)"
+    }
+})
+
+
 @app.get("/")
 async def root():
-    return {
-        "message": "ComfyUI Bridge API is running",
-        "comfy_url": COMFY_URL,
-        "endpoints": {
-            "generate_image": "/generate-image (POST)",
-            "health": "/health (GET)"
-        }
-    }
+    return Response(content=_ROOT_BODY, media_type="application/json")
+
+
+_health_cache: Optional[tuple] = None
+HEALTH_CACHE_TTL = 2.0
 
 
 @app.get("/health")
 async def health_check():
+    global _health_cache
+
+    if _health_cache is not None and time.monotonic() - _health_cache[0] < HEALTH_CACHE_TTL:
+        return _health_cache[1]
+
     try:
-        async with httpx.AsyncClient(timeout=5.0) as http_client:
-            response = await http_client.get(f"{COMFY_URL}/system_stats")
-            response.raise_for_status()
-            return {
-                "status": "healthy",
-                "comfy_ui": "online",
-                "comfy_url": COMFY_URL
-            }
+        response = await app.state.http.get("/system_stats", timeout=5.0)
+        response.raise_for_status()
+        result = {
+            "status": "healthy",
+            "comfy_ui": "online",
+            "comfy_url": COMFY_URL
+        }
+        _health_cache = (time.monotonic(), result)
+        return result
     except Exception as e:
+        _health_cache = None
         return {
             "status": "unhealthy",
             "comfy_ui": "offline",
@@ -272,15 +501,15 @@ async def health_check():
 
 
 @app.post("/generate-image", response_model=GenerateImageResponse)
-async def generate_image(request: GenerateImageRequest):
+async def generate_image(request: GenerateImageRequest = Depends(parse_generate_request)):
     try:
-        print(f"\n{'='*60}")
-        print(f"New image generation request")
-        print(f"Positive prompt: {request.prompt[:100]}...")
-        print(f"Negative prompt: {request.negative_prompt[:100] if request.negative_prompt else 'None'}...")
-        print(f"{'='*60}\n")
+        logger.info(
+            "New image generation request: prompt_len=%d negative_len=%d",
+            len(request.prompt),
+            len(request.negative_prompt or "")
+        )
 
-        workflow = client.load_workflow(WORKFLOW_PATH)
+        workflow = client.load_workflow()
 
         modified_workflow = client.modify_workflow(
             workflow,
@@ -290,9 +519,9 @@ async def generate_image(request: GenerateImageRequest):
 
         prompt_id = await client.queue_prompt(modified_workflow)
 
-        await client.wait_for_completion(prompt_id)
+        image_info = await client.wait_for_completion(prompt_id)
 
-        image_path = await client.download_image(prompt_id, COMFY_OUTPUT_DIR)
+        image_path = await client.download_image(prompt_id, COMFY_OUTPUT_DIR, image_info)
 
         return GenerateImageResponse(
             status="success",
@@ -312,17 +541,23 @@ async def generate_image(request: GenerateImageRequest):
 
 @app.get("/download/{prompt_id}")
 async def download_generated_image(prompt_id: str):
-    output_dir = Path(COMFY_OUTPUT_DIR)
+    cached_path = client.generated_paths.get(prompt_id)
 
-    matching_files = list(output_dir.glob(f"{prompt_id}_*"))
+    if cached_path is not None:
+        image_path = Path(cached_path)
+    else:
+        output_dir = Path(COMFY_OUTPUT_DIR)
 
-    if not matching_files:
-        raise HTTPException(
-            status_code=404,
-            detail=f"No image found for prompt ID: {prompt_id}"
-        )
+        matching_files = list(output_dir.glob(f"{prompt_id}_*"))
+
+        if not matching_files:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No image found for prompt ID: {prompt_id}"
+            )
 
-    image_path = matching_files[0]
+        image_path = matching_files[0]
+        client.generated_paths[prompt_id] = str(image_path)
 
     return FileResponse(
         path=str(image_path),